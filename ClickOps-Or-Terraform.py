@@ -22,13 +22,97 @@ import subprocess
 import sys
 import csv
 import argparse
+import base64
+import functools
+import hashlib
+import http.client
+import re
+import os
+import ssl
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from contextlib import ExitStack
+from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Any
+from typing import Dict, Iterable, List, Any
 import textwrap
 
+# Use orjson for parsing large Resource Graph responses when it is installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # Define the full path to Azure CLI
 AZ_CLI_PATH = r"C:\Program Files\Microsoft SDKs\Azure\CLI2\wbin\az.cmd"
 
+# Column headers for the CSV export
+CSV_HEADER = [
+    'Subscription',
+    'Resource Name',
+    'Resource Type',
+    'Resource Group',
+    'Tags',
+    'Created Time',
+    'Portal Creation Indicators'
+]
+
+# Tag keys/values that indicate a resource was deployed through automation
+AUTOMATION_INDICATORS = frozenset({
+    'terraform',
+    'arm-template',
+    'bicep',
+    'pulumi',
+    'cloudformation',
+    'managed-by',
+    'created-by',
+    'provisioner',
+    'environment',
+    'automation'
+})
+
+# Single precompiled pattern matching any automation indicator in one pass
+AUTOMATION_INDICATORS_RE = re.compile('|'.join(map(re.escape, sorted(AUTOMATION_INDICATORS))))
+
+# Case-insensitive marker left in metadata by the Terraform azurerm provider
+AZURERM_RE = re.compile(r'azurerm', re.IGNORECASE)
+
+# Number of distinct resource metadata combinations to memoize during classification
+CLASSIFY_CACHE_SIZE = 4096
+
+# Identity fields that can carry an 'azurerm' marker
+IDENTITY_FIELDS = ('type', 'principalId', 'tenantId')
+
+# Location and lifetime of the cached subscription list and Resource Manager endpoint
+CACHE_DIR = Path.home() / ".cache" / "clickops"
+CACHE_TTL = 2 * 60 * 60  # seconds
+
+# Azure Resource Graph REST API version
+RESOURCE_GRAPH_API_VERSION = "2021-03-01"
+
+# Azure Resource Graph query used to list resources across all selected subscriptions
+RESOURCE_GRAPH_QUERY = (
+    "Resources "
+    "| project id, name, type, resourceGroup, subscriptionId, tags, "
+    "createdBy = tostring(identity.principalId), managedBy, identity, "
+    "provisioningState = tostring(properties.provisioningState), "
+    "createdTime = coalesce(tostring(properties.timeCreated), "
+    "tostring(properties.creationTime), tostring(systemData.createdAt))"
+)
+
+# Maximum number of rows Azure Resource Graph returns per page
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+
+# Maximum number of subscriptions a single Resource Graph query can be scoped to
+RESOURCE_GRAPH_SUBSCRIPTION_BATCH_SIZE = 1000
+
+# Socket timeout and throttling (HTTP 429) retry policy for Resource Graph requests
+RESOURCE_GRAPH_TIMEOUT = 60  # seconds
+RESOURCE_GRAPH_MAX_THROTTLE_RETRIES = 5
+RESOURCE_GRAPH_DEFAULT_RETRY_DELAY = 5  # seconds, when Retry-After is missing
+
 def parse_args():
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
@@ -38,6 +122,9 @@ def parse_args():
             Examples:
               %(prog)s                     # Run analysis with interactive subscription selection
               %(prog)s --output results.csv # Export results to CSV file
+              %(prog)s --refresh-subs       # Ignore the cached subscription list
+              %(prog)s --subscription <id>  # Analyze a specific subscription (repeatable)
+              %(prog)s --all-subscriptions  # Analyze every subscription without prompting
         """)
     )
     parser.add_argument(
@@ -45,6 +132,23 @@ def parse_args():
         help='Export results to specified CSV file (e.g., results.csv)',
         type=str
     )
+    parser.add_argument(
+        '--refresh-subs',
+        help='Bypass the cached subscription list and fetch it from Azure CLI',
+        action='store_true'
+    )
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument(
+        '--subscription',
+        help='Subscription ID to analyze; may be given multiple times (skips the interactive prompt)',
+        action='append',
+        metavar='ID'
+    )
+    selection.add_argument(
+        '--all-subscriptions',
+        help='Analyze all available subscriptions (skips the interactive prompt)',
+        action='store_true'
+    )
     return parser.parse_args()
 
 def check_az_cli():
@@ -60,126 +164,382 @@ def check_az_cli():
 def ensure_az_login():
     """
     Ensure the user is logged into Azure CLI. If not, prompt for login.
+    Returns the logged-in account as a list of [user name, tenant ID, cloud name].
     """
+    show_command = [AZ_CLI_PATH, 'account', 'show',
+                    '--query', '[user.name, tenantId, environmentName]',
+                    '-o', 'json']
     try:
-        subprocess.check_output([AZ_CLI_PATH, 'account', 'show'], stderr=subprocess.STDOUT)
+        return json.loads(subprocess.check_output(show_command, stderr=subprocess.DEVNULL))
     except subprocess.CalledProcessError:
         print("🔑 Azure CLI is not logged in. Attempting to log in...")
         try:
             subprocess.check_call([AZ_CLI_PATH, 'login'])
             print("✅ Azure CLI login successful.")
+            return json.loads(subprocess.check_output(show_command))
         except subprocess.CalledProcessError as e:
             print(f"❌ Error: Azure login failed. Details: {e}")
             sys.exit(1)
 
-def get_subscriptions():
+def get_cache_path(account: List[str], name: str) -> Path:
+    """
+    Return the cache file with the given name for the given account. The user, tenant and
+    cloud are all part of the key, so different logins, tenants and clouds don't collide.
+    """
+    account_key = '\n'.join(str(field or '') for field in account)
+    account_hash = hashlib.sha256(account_key.encode('utf-8')).hexdigest()[:16]
+    return CACHE_DIR / f"{name}-{account_hash}.json"
+
+def load_cache(cache_path: Path, parse=lambda value: value):
+    """
+    Load a cached value if it exists and is younger than the cache TTL, converting it with parse.
+    Returns None on a cache miss.
+    """
+    try:
+        if time.time() - cache_path.stat().st_mtime > CACHE_TTL:
+            return None
+        with open(cache_path, encoding='utf-8') as cache_file:
+            return parse(json.load(cache_file))
+    except (OSError, ValueError, TypeError):
+        return None
+
+def save_cache(cache_path: Path, value):
+    """
+    Atomically write a value to the cache. Failures are ignored.
+    """
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+                json.dump(value, tmp_file)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+
+def get_subscriptions(account: List[str], refresh: bool = False):
     """
-    Fetch all available Azure subscriptions.
-    Returns a list of subscription IDs and their names.
+    Fetch all available Azure subscriptions, using the on-disk cache when it is fresh.
+    Returns a tuple of (dict mapping subscription IDs to their names, whether the list was
+    freshly fetched from Azure CLI rather than read from the cache).
     """
+    cache_path = get_cache_path(account, 'subs')
+    if not refresh:
+        cached = load_cache(cache_path, dict)
+        if cached is not None:
+            return cached, False
+
     try:
         subscriptions_json = subprocess.check_output([AZ_CLI_PATH, 'account', 'list', '-o', 'json'])
         subscriptions = json.loads(subscriptions_json)
-        return [(sub['id'], sub['name']) for sub in subscriptions]
+        subscriptions = {sub['id']: sub['name'] for sub in subscriptions}
     except subprocess.CalledProcessError as e:
         print(f"❌ Error: Unable to fetch subscriptions. Details: {e}")
         sys.exit(1)
 
+    # Don't cache an empty list, so newly granted access shows up on the next run
+    if subscriptions:
+        save_cache(cache_path, subscriptions)
+    return subscriptions, True
+
+def resolve_subscriptions(subscriptions, requested_ids: List[str], account: List[str], refreshed: bool = False):
+    """
+    Validate subscription IDs given on the command line against the available subscriptions.
+    If any ID is unknown and the list came from the cache, it is refetched once bypassing the cache.
+    Returns a tuple of (subscriptions, list of subscription IDs to evaluate).
+    """
+    available_ids = {sub_id.lower(): sub_id for sub_id in subscriptions}
+    unknown = [sub_id for sub_id in requested_ids if sub_id.lower() not in available_ids]
+    if unknown and not refreshed:
+        subscriptions, refreshed = get_subscriptions(account, refresh=True)
+        return resolve_subscriptions(subscriptions, requested_ids, account, refreshed=refreshed)
+    if unknown:
+        print(f"❌ Error: Unknown subscription ID(s): {', '.join(unknown)}")
+        sys.exit(1)
+    return subscriptions, list(dict.fromkeys(available_ids[sub_id.lower()] for sub_id in requested_ids))
+
 def select_subscription(subscriptions):
     """
     Prompt the user to select a subscription or evaluate all.
+    Without an interactive terminal, the first subscription is selected.
     Returns a list of subscription IDs to evaluate.
     """
+    if not sys.stdin.isatty():
+        sub_id, name = next(iter(subscriptions.items()))
+        print(f"\nℹ️  No interactive terminal; analyzing subscription: {name}")
+        return [sub_id]
+
+    choices = list(subscriptions.items())
     print("\n📋 Available Subscriptions:")
-    for idx, (_, name) in enumerate(subscriptions):
+    for idx, (_, name) in enumerate(choices):
         print(f"  {idx + 1}: {name}")
-    print(f"  {len(subscriptions) + 1}: Evaluate all subscriptions")
+    print(f"  {len(choices) + 1}: Evaluate all subscriptions")
 
     while True:
         try:
             choice = int(input("\n📎 Select a subscription (enter the number): "))
-            if choice == len(subscriptions) + 1:
-                return [sub[0] for sub in subscriptions]
-            elif 1 <= choice <= len(subscriptions):
-                return [subscriptions[choice - 1][0]]
+        except EOFError:
+            print("\n❌ Error: No subscription selected.")
+            sys.exit(1)
         except ValueError:
             pass
+        else:
+            if choice == len(choices) + 1:
+                return list(subscriptions)
+            elif 1 <= choice <= len(choices):
+                return [choices[choice - 1][0]]
         print("❌ Invalid choice. Please try again.")
 
-def fetch_resource_details(subscription_id):
+def get_arm_endpoint(account: List[str]) -> str:
     """
-    Fetch detailed information about all Azure resources for a given subscription.
-    Returns a list of resources with their metadata.
+    Look up the Azure Resource Manager endpoint of the active Azure CLI cloud,
+    so sovereign clouds selected with 'az cloud set' are honored.
+    The endpoint is cached alongside the subscription list.
     """
+    cache_path = get_cache_path(account, 'arm')
+    cached = load_cache(cache_path, str)
+    if cached:
+        return cached
+
     try:
-        # Single-line query string
-        query = "[].{id:id, name:name, type:type, resourceGroup:resourceGroup, tags:tags, createdTime:createdTime, createdBy:identity.principalId, managedBy:managedBy, identity:identity, provisioningState:provisioningState}"
-        
-        az_resources_json = subprocess.check_output(
-            [AZ_CLI_PATH, 'resource', 'list', 
-             '--subscription', subscription_id,
-             '--query', query,
-             '-o', 'json']
-        )
-        return json.loads(az_resources_json)
+        arm_endpoint = subprocess.check_output(
+            [AZ_CLI_PATH, 'cloud', 'show',
+             '--query', 'endpoints.resourceManager',
+             '--only-show-errors',
+             '-o', 'tsv'],
+            text=True
+        ).strip()
     except subprocess.CalledProcessError as e:
-        print(f"❌ Error: Failed to fetch resources for subscription {subscription_id}. Details: {e}")
+        print(f"❌ Error: Unable to determine the Azure Resource Manager endpoint. Details: {e}")
         sys.exit(1)
 
+    save_cache(cache_path, arm_endpoint)
+    return arm_endpoint
+
+def get_arm_access_token(arm_endpoint: str) -> str:
+    """
+    Acquire an Azure Resource Manager access token from the Azure CLI login.
+    """
+    try:
+        return subprocess.check_output(
+            [AZ_CLI_PATH, 'account', 'get-access-token',
+             '--resource', arm_endpoint,
+             '--query', 'accessToken',
+             '--only-show-errors',
+             '-o', 'tsv'],
+            text=True
+        ).strip()
+    except subprocess.CalledProcessError as e:
+        print(f"❌ Error: Unable to acquire an Azure access token. Details: {e}")
+        sys.exit(1)
+
+def get_retry_delay(retry_after) -> float:
+    """
+    Convert a Retry-After header value in seconds to a delay, falling back to the default.
+    """
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return RESOURCE_GRAPH_DEFAULT_RETRY_DELAY
+
+def query_resource_graph(connection: http.client.HTTPSConnection, token: str,
+                         subscription_ids: List[str], skip_token=None):
+    """
+    Fetch one page of Azure Resource Graph results over an open HTTPS connection.
+    A keep-alive connection dropped by the server is reopened once, and throttled (429)
+    requests are retried after the delay given in Retry-After.
+    Returns a tuple of (resources, next_skip_token).
+    """
+    options = {'$top': RESOURCE_GRAPH_PAGE_SIZE, 'resultFormat': 'objectArray'}
+    if skip_token:
+        options['$skipToken'] = skip_token
+
+    request_body = json.dumps({
+        'subscriptions': subscription_ids,
+        'query': RESOURCE_GRAPH_QUERY,
+        'options': options
+    })
+    reconnected = False
+    throttle_retries = 0
+
+    while True:
+        try:
+            connection.request(
+                'POST',
+                f"/providers/Microsoft.ResourceGraph/resources?api-version={RESOURCE_GRAPH_API_VERSION}",
+                body=request_body,
+                headers={'Authorization': f"Bearer {token}", 'Content-Type': 'application/json'}
+            )
+            response = connection.getresponse()
+            body = response.read()
+        except (ConnectionResetError, BrokenPipeError):
+            # The server closed the idle keep-alive socket; http.client reopens it on the next request
+            if reconnected:
+                raise
+            reconnected = True
+            connection.close()
+            continue
+
+        if response.status == 429 and throttle_retries < RESOURCE_GRAPH_MAX_THROTTLE_RETRIES:
+            throttle_retries += 1
+            delay = get_retry_delay(response.getheader('Retry-After'))
+            print(f"⏳ Azure Resource Graph is throttling requests; retrying in {delay:g}s...")
+            time.sleep(delay)
+            continue
+
+        if response.status != 200:
+            raise http.client.HTTPException(
+                f"HTTP {response.status} {response.reason}: {body.decode('utf-8', 'replace')}"
+            )
+
+        page = json_loads(body)
+        return page.get('data', []), page.get('$skipToken')
+
+def open_arm_connection(arm_endpoint: str) -> http.client.HTTPSConnection:
+    """
+    Open a keep-alive HTTPS connection to the Resource Manager endpoint.
+    HTTPS_PROXY/NO_PROXY are honored by tunnelling through the proxy, and a CA bundle
+    configured for Azure CLI via REQUESTS_CA_BUNDLE is trusted.
+    """
+    arm_url = urllib.parse.urlsplit(arm_endpoint)
+    try:
+        context = ssl.create_default_context(cafile=os.environ.get('REQUESTS_CA_BUNDLE'))
+    except (OSError, ssl.SSLError) as e:
+        print(f"❌ Error: Unable to load the CA bundle from REQUESTS_CA_BUNDLE. Details: {e}")
+        sys.exit(1)
+
+    proxy = urllib.request.getproxies().get('https')
+    if not proxy or urllib.request.proxy_bypass(arm_url.hostname):
+        return http.client.HTTPSConnection(arm_url.netloc, timeout=RESOURCE_GRAPH_TIMEOUT, context=context)
+
+    proxy_url = urllib.parse.urlsplit(proxy if '://' in proxy else f"http://{proxy}")
+    connection = http.client.HTTPSConnection(
+        proxy_url.hostname, proxy_url.port or 80, timeout=RESOURCE_GRAPH_TIMEOUT, context=context
+    )
+    tunnel_headers = {}
+    if proxy_url.username:
+        credentials = f"{urllib.parse.unquote(proxy_url.username)}:{urllib.parse.unquote(proxy_url.password or '')}"
+        tunnel_headers['Proxy-Authorization'] = f"Basic {base64.b64encode(credentials.encode('utf-8')).decode('ascii')}"
+    connection.set_tunnel(arm_url.hostname, arm_url.port, headers=tunnel_headers)
+    return connection
+
+def fetch_resource_details(subscription_ids, arm_endpoint: str):
+    """
+    Fetch detailed information about all Azure resources across the given subscriptions
+    with Azure Resource Graph queries, one per batch of up to RESOURCE_GRAPH_SUBSCRIPTION_BATCH_SIZE
+    subscriptions, following skip tokens until all pages are read.
+    A single access token and keep-alive HTTPS connection are reused for every page.
+    Yields resources page by page, so only one page is held in memory at a time.
+    """
+    token = get_arm_access_token(arm_endpoint)
+    connection = open_arm_connection(arm_endpoint)
+
+    try:
+        for start in range(0, len(subscription_ids), RESOURCE_GRAPH_SUBSCRIPTION_BATCH_SIZE):
+            batch = subscription_ids[start:start + RESOURCE_GRAPH_SUBSCRIPTION_BATCH_SIZE]
+            skip_token = None
+            while True:
+                resources, skip_token = query_resource_graph(connection, token, batch, skip_token)
+                yield from resources
+
+                if not skip_token:
+                    break
+    except (http.client.HTTPException, OSError) as e:
+        print(f"❌ Error: Failed to fetch resources from Azure Resource Graph. Details: {e}")
+        sys.exit(1)
+    finally:
+        connection.close()
+
+def identity_contains_azurerm(identity: Dict[str, Any]) -> bool:
+    """
+    Check the known identity fields, and the resource IDs of any user-assigned identities,
+    for an 'azurerm' marker without serializing the whole identity block.
+    """
+    if any(AZURERM_RE.search(identity.get(field) or '') for field in IDENTITY_FIELDS):
+        return True
+    user_assigned = identity.get('userAssignedIdentities') or {}
+    return any(AZURERM_RE.search(identity_id) for identity_id in user_assigned)
+
 def is_portal_created(resource: Dict[str, Any]) -> tuple[bool, List[str]]:
     """
     Determine if a resource was created through the Azure portal by checking multiple indicators.
     Returns a tuple of (is_portal_created, reasons).
     """
+    identity = resource.get('identity', {}) or {}
+    tags = resource.get('tags', {}) or {}
+
+    is_portal, reasons = classify_metadata(
+        isinstance(identity, dict) and identity_contains_azurerm(identity),
+        resource.get('managedBy', '') or '',
+        resource.get('createdBy', '') or '',
+        frozenset(tags.items()),
+        resource.get('provisioningState', '') or ''
+    )
+    return is_portal, list(reasons)
+
+@functools.lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def classify_metadata(identity_has_azurerm: bool, managed_by: str, created_by: str,
+                      tag_items: frozenset, provisioning_state: str) -> tuple[bool, tuple]:
+    """
+    Classify the hashable subset of a resource's metadata. Results are memoized, since
+    resources such as scale set members and replicas often share identical metadata.
+    Returns a tuple of (is_portal_created, reasons).
+    """
     reasons = []
     
     # Check for azurerm in various metadata fields
-    identity = resource.get('identity', {}) or {}
-    managed_by = resource.get('managedBy', '')
-    created_by = resource.get('createdBy', '')
-    
-    if isinstance(identity, dict) and 'azurerm' in str(identity).lower():
+    if identity_has_azurerm:
         reasons.append("Resource identity contains 'azurerm' identifier")
     
-    if managed_by and 'azurerm' in managed_by.lower():
+    if managed_by and AZURERM_RE.search(managed_by):
         reasons.append("Resource managedBy field contains 'azurerm'")
         
-    if created_by and 'azurerm' in created_by.lower():
+    if created_by and AZURERM_RE.search(created_by):
         reasons.append("Resource createdBy field contains 'azurerm'")
 
     # Check for absence of automation tags
-    tags = resource.get('tags', {}) or {}
-    automation_indicators = {
-        'terraform',
-        'arm-template',
-        'bicep',
-        'pulumi',
-        'cloudformation',
-        'managed-by',
-        'created-by',
-        'provisioner',
-        'environment',
-        'automation'
-    }
-    
-    tags_lower = {k.lower(): str(v).lower() for k, v in tags.items()}
-    has_automation_tags = any(
-        indicator in k or indicator in v 
-        for k, v in tags_lower.items() 
-        for indicator in automation_indicators
-    )
+    if tag_items:
+        # Tag values are almost always strings; only wrap the odd non-string value
+        tags_blob = '\n'.join(
+            f"{k.lower()}={(v if isinstance(v, str) else str(v)).lower()}"
+            for k, v in tag_items
+        )
+        has_automation_tags = AUTOMATION_INDICATORS_RE.search(tags_blob) is not None
+    else:
+        has_automation_tags = False
     
-    if not tags:
+    if not tag_items:
         reasons.append("Resource has no tags")
     elif not has_automation_tags:
         reasons.append("Resource lacks automation-related tags")
 
     # Check for manual provisioning indicators
-    provisioning_state = resource.get('provisioningState', '').lower()
-    if provisioning_state == 'succeeded' and not has_automation_tags:
+    if provisioning_state.lower() == 'succeeded' and not has_automation_tags:
         reasons.append("Resource was provisioned without automation tags")
 
-    return bool(reasons), reasons
+    return bool(reasons), tuple(reasons)
+
+def classify_resources(resources: Iterable[Dict[str, Any]], subscription_ids: List[str]):
+    """
+    Classify a stream of resources in a single pass, grouped by subscription.
+    Only portal-created resources are kept; the rest are just counted.
+    Returns a tuple of (resource counts, portal-created (resource, reasons) lists), both keyed by subscription ID.
+    """
+    resource_counts = dict.fromkeys(subscription_ids, 0)
+    portal_created = {subscription_id: [] for subscription_id in subscription_ids}
+
+    for resource in resources:
+        subscription_id = resource['subscriptionId']
+        resource_counts[subscription_id] = resource_counts.get(subscription_id, 0) + 1
+
+        is_portal, reasons = is_portal_created(resource)
+        if is_portal:
+            portal_created.setdefault(subscription_id, []).append((resource, reasons))
+
+    return resource_counts, portal_created
 
 def format_resource_output(resource: Dict[str, Any], reasons: List[str]) -> str:
     """
@@ -194,7 +554,7 @@ def format_resource_output(resource: Dict[str, Any], reasons: List[str]) -> str:
         f"  Resource Group: {resource['resourceGroup']}",
         f"  Tags:",
         f"    {tags_str}",
-        f"  Created Time: {resource.get('createdTime', 'Unknown')}",
+        f"  Created Time: {resource.get('createdTime') or 'Unknown'}",
         f"  Portal Creation Indicators:",
     ]
     
@@ -203,45 +563,28 @@ def format_resource_output(resource: Dict[str, Any], reasons: List[str]) -> str:
     
     return '\n'.join(output)
 
-def export_to_csv(portal_resources: List[tuple], filename: str, subscription_name: str):
+def export_to_csv(writer, portal_resources: List[tuple], subscription_name: str):
     """
-    Export portal-created resources to a CSV file.
+    Write portal-created resources for one subscription to an already open CSV writer.
+    Returns True if the rows were written successfully.
     """
     try:
-        with open(filename, 'a', newline='', encoding='utf-8') as csvfile:
-            writer = csv.writer(csvfile)
-            
-            # Write header if file is empty
-            if csvfile.tell() == 0:
-                writer.writerow([
-                    'Subscription',
-                    'Resource Name',
-                    'Resource Type',
-                    'Resource Group',
-                    'Tags',
-                    'Created Time',
-                    'Portal Creation Indicators'
-                ])
-            
-            # Write data
-            for resource, reasons in portal_resources:
-                tags = resource.get('tags', {}) or {}
-                tags_str = '; '.join([f"{k}={v}" for k, v in tags.items()]) if tags else "No tags"
-                reasons_str = '; '.join(reasons)
-                
-                writer.writerow([
-                    subscription_name,
-                    resource['name'],
-                    resource['type'],
-                    resource['resourceGroup'],
-                    tags_str,
-                    resource.get('createdTime', 'Unknown'),
-                    reasons_str
-                ])
-        
-        print(f"\n✅ Results exported to {filename}")
+        writer.writerows(
+            [
+                subscription_name,
+                resource['name'],
+                resource['type'],
+                resource['resourceGroup'],
+                '; '.join(f"{k}={v}" for k, v in (resource.get('tags', {}) or {}).items()) or "No tags",
+                resource.get('createdTime') or 'Unknown',
+                '; '.join(reasons)
+            ]
+            for resource, reasons in portal_resources
+        )
+        return True
     except Exception as e:
         print(f"\n❌ Error exporting to CSV: {str(e)}")
+        return False
 
 def main():
     """
@@ -253,53 +596,76 @@ def main():
     print("================================")
     
     check_az_cli()
-    ensure_az_login()
+    account = ensure_az_login()
 
-    subscriptions = get_subscriptions()
-    selected_subscriptions = select_subscription(subscriptions)
+    subscriptions, refreshed = get_subscriptions(account, refresh=args.refresh_subs)
+    if not subscriptions:
+        print("❌ Error: No Azure subscriptions are available for this account.")
+        sys.exit(1)
+
+    if args.all_subscriptions:
+        selected_subscriptions = list(subscriptions)
+    elif args.subscription:
+        subscriptions, selected_subscriptions = resolve_subscriptions(
+            subscriptions, args.subscription, account, refreshed=refreshed
+        )
+    else:
+        selected_subscriptions = select_subscription(subscriptions)
 
     print("\n⚙️  Analyzing resources...")
     
     total_resources = 0
     total_portal_created = 0
     
-    # If output file specified, create/clear it
-    if args.output:
-        try:
-            open(args.output, 'w').close()
-        except Exception as e:
-            print(f"\n❌ Error creating CSV file: {str(e)}")
-            sys.exit(1)
-    
-    for subscription_id in selected_subscriptions:
-        sub_name = next(name for id, name in subscriptions if id == subscription_id)
-        print(f"\n📊 Analyzing subscription: {sub_name}")
+    with ExitStack() as stack:
+        # If output file specified, open it once and write the header up front
+        csv_writer = None
+        csv_export_ok = True
+        if args.output:
+            try:
+                csv_file = stack.enter_context(open(args.output, 'w', newline='', encoding='utf-8'))
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(CSV_HEADER)
+            except Exception as e:
+                print(f"\n❌ Error creating CSV file: {str(e)}")
+                sys.exit(1)
+
+        # Classify resources as they stream in, keeping only the portal-created ones
+        resource_counts, portal_created_by_subscription = classify_resources(
+            fetch_resource_details(selected_subscriptions, get_arm_endpoint(account)),
+            selected_subscriptions
+        )
+
+        for subscription_id in selected_subscriptions:
+            sub_name = subscriptions[subscription_id]
+            print(f"\n📊 Analyzing subscription: {sub_name}")
         
-        resources = fetch_resource_details(subscription_id)
-        total_resources += len(resources)
+            subscription_resource_count = resource_counts[subscription_id]
+            total_resources += subscription_resource_count
         
-        portal_created_resources = []
-        for resource in resources:
-            is_portal, reasons = is_portal_created(resource)
-            if is_portal:
-                portal_created_resources.append((resource, reasons))
+            portal_created_resources = portal_created_by_subscription[subscription_id]
         
-        total_portal_created += len(portal_created_resources)
+            total_portal_created += len(portal_created_resources)
         
-        print(f"\nFound {len(portal_created_resources)} portal-created resources "
-              f"out of {len(resources)} total resources in this subscription.")
+            print(f"\nFound {len(portal_created_resources)} portal-created resources "
+                  f"out of {subscription_resource_count} total resources in this subscription.")
         
-        if portal_created_resources:
-            print("\n🔎 Portal-Created Resources:")
-            for resource, reasons in portal_created_resources:
-                print("\n" + "─" * 80)
-                print(format_resource_output(resource, reasons))
+            if portal_created_resources:
+                # Build the whole report for this subscription and write it in one call
+                chunks = [
+                    "\n" + "─" * 80 + "\n" + format_resource_output(resource, reasons) + "\n"
+                    for resource, reasons in portal_created_resources
+                ]
+                sys.stdout.write("\n🔎 Portal-Created Resources:\n" + "".join(chunks))
             
-            # Export to CSV if output file specified
-            if args.output:
-                export_to_csv(portal_created_resources, args.output, sub_name)
-        else:
-            print("\n✅ No portal-created resources found in this subscription.")
+                # Export to CSV if output file specified
+                if csv_writer:
+                    csv_export_ok = export_to_csv(csv_writer, portal_created_resources, sub_name) and csv_export_ok
+            else:
+                print("\n✅ No portal-created resources found in this subscription.")
+
+    if args.output and csv_export_ok:
+        print(f"\n✅ Results exported to {args.output}")
     
     print("\n📈 Summary")
     print("=========")